@@ -3,6 +3,8 @@ import string
 import io
 import sys
 import operator
+import functools
+import re
 from collections import namedtuple
 
 class ErioError(Exception): pass
@@ -32,64 +34,150 @@ symbols = {'(':     'open-paren',
            '*':     'mul',
            '/':     'div',
            '%':     'mod'}
-tests = {
-    'boolean':      lambda s: s in ('true','false'),
-    'identifier':   lambda s: s.isidentifier(),
-    'integer':      lambda s: s.isdigit(),
-    'string':       lambda s: s.startswith('"')
-                          and s.endswith('"')
-                          and s.isprintable()}
 quote = '"'
 
-def make_token(value):
-    if value in keywords:
-        return Token(value, value)
-    elif value in symbols:
-        return Token(symbols[value], value)
-    else:
-        for name, test in tests.items():
-            if test(value):
-                return Token(name, value)
-    raise ErioInvalidTokenError(value)
-
-def tokenize(stream):
-    '''Creates a generator which returns the tokens from the stream'''
-
-    buffer = ''
-    instring = False
-    for c in stream:
-        if instring and c != quote:
-           buffer += c
-           continue
-        if c == quote:
-            if instring:
-                instring = False
-                buffer += c
-                yield make_token(buffer)
-                buffer = ''
-                continue
-            else:
-                instring = True
-        #Make sure to check for multi-char symbols
-        if buffer in symbols and buffer + c not in symbols:
-            yield make_token(buffer)
-            buffer = c.strip()
+#Character classes used by the scanners. Every latin-1 character is classified
+#once at import; the token regex is built from the classes and the Cython
+#scanner looks them up once per character.
+#OPERATOR_PREFIX characters may start a two character symbol, OPERATOR ones
+#never do. ALPHA and DIGIT come last so 'cls >= ALPHA' tests for a word
+#character.
+(INVALID, WHITESPACE, QUOTE, OPERATOR, OPERATOR_PREFIX, ALPHA,
+ DIGIT) = range(7)
+TWO_CHAR_SYMBOLS = frozenset(s for s in symbols if len(s) == 2)
+SYMBOL_FIRSTS = frozenset(s[0] for s in symbols)
+
+def _char_class(c):
+    if c.isspace():
+        return WHITESPACE
+    elif c.isdigit() and c.isascii():
+        return DIGIT
+    elif c.isidentifier():
+        return ALPHA
+    elif c == quote:
+        return QUOTE
+    elif any(s[0] == c for s in TWO_CHAR_SYMBOLS):
+        return OPERATOR_PREFIX
+    elif c in SYMBOL_FIRSTS:
+        return OPERATOR
+    return INVALID
+
+CHAR_CLASS = bytes(_char_class(chr(i)) for i in range(256))
+
+#Every fixed token maps straight to its Token, so the scanner resolves keywords,
+#booleans and symbols with a single dict lookup. Token types are interned so
+#the parser's type comparisons usually succeed on identity.
+TOKEN_TABLE = {k: Token(sys.intern(k), k) for k in keywords}
+TOKEN_TABLE.update((b, Token('boolean', b)) for b in ('true', 'false'))
+TOKEN_TABLE.update((s, Token(sys.intern(name), s))
+                   for s, name in symbols.items())
+
+def _chars(*classes):
+    return re.escape(''.join(chr(i) for i in range(256)
+                             if CHAR_CLASS[i] in classes))
+
+#Characters above latin-1 are not in CHAR_CLASS. The whitespace among them
+#(none is above U+3000) is skipped, and any other one may be part of a word,
+#which then has to be a valid identifier.
+UNICODE_SPACES = ''.join(c for c in map(chr, range(256, 0x3001))
+                         if c.isspace())
+
+def _unicode_word_chars():
+    ranges = []
+    start = 256
+    for end in [ord(c) for c in UNICODE_SPACES] + [sys.maxunicode + 1]:
+        if start < end:
+            ranges.append('{}-{}'.format(re.escape(chr(start)),
+                                         re.escape(chr(end - 1))))
+        start = end + 1
+    return ''.join(ranges)
+
+#All tokens are recognised by one regex, so the scanning loop runs in the
+#regex engine and Python only dispatches on the kind of each match. The
+#alternatives are ordered so that 'end-' words win over plain words, and
+#anything no other alternative accepts is matched as invalid.
+TOKEN_RE = re.compile(r'''
+    [{space}{unicode_space}]+
+  | (?P<word>end-[{word}{unicode}]*|[{alpha}{unicode}][{word}{unicode}]*)
+  | (?P<integer>[0-9]+(?![{word}{unicode}]))
+  | (?P<symbol>{two}|[{one}])
+  | (?P<string>"[^"]*")
+  | (?P<invalid>[0-9][{word}{unicode}]*|"|.)
+'''.format(space=_chars(WHITESPACE), unicode_space=re.escape(UNICODE_SPACES),
+           word=_chars(ALPHA, DIGIT), alpha=_chars(ALPHA),
+           unicode=_unicode_word_chars(),
+           two='|'.join(re.escape(s) for s in sorted(TWO_CHAR_SYMBOLS)),
+           one=re.escape(''.join(s for s in symbols if len(s) == 1))),
+    re.VERBOSE | re.DOTALL)
+
+def tokenize(src):
+    '''Creates a generator which returns the tokens from the source string'''
+
+    #Calling the scanner's match directly skips the finditer wrapper
+    for match in iter(TOKEN_RE.scanner(src).match, None):
+        kind = match.lastgroup
+        if kind is None:
+            #Whitespace
             continue
-        #We have found the end of a token if we have hit whitespace or the
-        #beginning of a symbol. We check to make sure we are not currently
-        #reading in a multi-char symbol before we split.
-        #We test for 'end' so that the '-' symbol doesn't split 'end-x'
-        #keywords.
-        if len(buffer) > 0 and (c.isspace() or \
-                (c in [s[0] for s in symbols] \
-                 and buffer + c not in symbols \
-                 and buffer != 'end')):
-            yield make_token(buffer)
-            buffer = ''
-        buffer += c.strip()
-    if len(buffer) > 0:
-        yield make_token(buffer)
-        buffer = ''
+        value = match.group()
+        if kind == 'word':
+            token = TOKEN_TABLE.get(value)
+            if token is not None:
+                yield token
+            #Catches words with a '-' other than 'end-if' and 'end-while',
+            #and words with characters above latin-1 which are not allowed
+            #in identifiers
+            elif not value.isidentifier():
+                raise ErioInvalidTokenError(value)
+            else:
+                #Interned names make the environment lookups identity hits
+                yield Token('identifier', sys.intern(value))
+        elif kind == 'symbol':
+            yield TOKEN_TABLE[value]
+        elif kind == 'integer':
+            yield Token('integer', value)
+        elif kind == 'string':
+            if not value.isprintable():
+                raise ErioInvalidTokenError(value)
+            yield Token('string', value)
+        elif value == quote:
+            raise ErioInvalidTokenError(src[match.start():])
+        else:
+            raise ErioInvalidTokenError(value)
+
+class Value:
+    '''A runtime value, holding the Python value it wraps in val. Values are
+    created for every intermediate result, so they use __slots__ rather than
+    namedtuples, which are slower to create and to read from.'''
+
+    __slots__ = ('val',)
+
+    def __init__(self, val):
+        self.val = val
+
+    #As when values were namedtuples, values of different types are
+    #equal when the values they wrap are, so [1] == [true] as 1 == true does.
+    def __eq__(self, other):
+        return isinstance(other, Value) and self.val == other.val
+
+    def __hash__(self):
+        return hash(self.val)
+
+    def __repr__(self):
+        return '{}(val={!r})'.format(type(self).__name__, self.val)
+
+class Integer(Value): __slots__ = ()
+class String(Value): __slots__ = ()
+class Boolean(Value): __slots__ = ()
+class Sequence(Value): __slots__ = ()
+
+Function = namedtuple('Function', ('env', 'args', 'body', 'locals', 'size',
+                                   'native', 'frame'),
+                      defaults=(None, 0, None, None))
+
+#Booleans are immutable, so every true and false value is one of these two
+TRUE = Boolean(True)
+FALSE = Boolean(False)
 
 IfStmnt = namedtuple('IfStmnt', ('cond', 'then', 'els'))
 WhileStmnt = namedtuple('WhileStmnt', ('cond', 'do'))
@@ -108,33 +196,87 @@ NotExpr = namedtuple('NotExpr', ('op', 'rhs'))
 CompExpr = namedtuple('CompExpr', ('op', 'lhs', 'rhs'))
 SignExpr = namedtuple('SignExpr', ('op', 'rhs'))
 
+#Nodes produced by resolve_function for the bodies of user defined functions
+LocalVariableExpr = namedtuple('LocalVariableExpr', ('slot', 'id'))
+LocalAssignmentStmnt = namedtuple('LocalAssignmentStmnt', ('slot', 'id', 'expr'))
+ResolvedFunctionDef = namedtuple('ResolvedFunctionDef',
+                                 ('id', 'args', 'body', 'locals', 'size',
+                                  'nested'))
+
+#Binding power of each binary operator token type, and the node it builds.
+#'not' is a prefix operator which binds between 'and' and the comparisons.
+binary_precedence = {
+    'or':       1,
+    'and':      2,
+    'eq':       4,
+    'gt':       4,
+    'lt':       4,
+    'gteq':     4,
+    'lteq':     4,
+    'noteq':    4,
+    'add':      5,
+    'sub':      5,
+    'mul':      6,
+    'div':      6,
+    'mod':      6}
+NOT_PRECEDENCE = 3
+binary_exprs = {
+    'or':       OrExpr,
+    'and':      AndExpr,
+    'eq':       CompExpr,
+    'gt':       CompExpr,
+    'lt':       CompExpr,
+    'gteq':     CompExpr,
+    'lteq':     CompExpr,
+    'noteq':    CompExpr,
+    'add':      AddExpr,
+    'sub':      AddExpr,
+    'mul':      MulExpr,
+    'div':      MulExpr,
+    'mod':      MulExpr}
+
+#The binary operator nodes, whose lhs may be a long left associative chain.
+#Passes over the tree walk down that chain in a loop rather than recursing.
+binary_nodes = frozenset((OrExpr, AndExpr, CompExpr, AddExpr, MulExpr))
+
 def parse(stream):
-    token = next(stream)
-    lookahead = next(stream)
+    #The stream is read lazily so statements can run as soon as they are
+    #parsed. Its end is marked by a single eof token rather than an exception.
+    eof = Token('eof', None)
+    read_token = functools.partial(next, stream, eof)
+    token = read_token()
+    lookahead = read_token()
+    #The parser mostly dispatches on token types alone, so the types of the
+    #current and lookahead tokens are kept in variables of their own and the
+    #tokens themselves are only read when building nodes.
+    kind = token.type
+    next_kind = lookahead.type
     def next_token():
-        nonlocal token, lookahead
+        nonlocal token, lookahead, kind, next_kind
         token = lookahead
-        lookahead = next(stream, Token('eof', None))
+        kind = next_kind
+        lookahead = read_token()
+        next_kind = lookahead.type
 
     def top_level_statement():
-        if token.type == 'return':
+        if kind == 'return':
             raise ErioSyntaxError('Return statement outside of function body')
         else:
             return statement()
 
     def statement():
-        if token.type == 'if':
+        if kind == 'if':
             return if_stmnt()
-        elif token.type == 'while':
+        elif kind == 'while':
             return while_stmnt()
-        elif token.type == 'def':
+        elif kind == 'def':
             return function_def()
-        elif token.type == 'return':
+        elif kind == 'return':
             return return_stmnt()
-        elif token.type == 'identifier':
-            if lookahead.type == 'assignment':
+        elif kind == 'identifier':
+            if next_kind == 'assignment':
                 return assignment_stmnt()
-            elif lookahead.type == 'open-paren':
+            elif next_kind == 'open-paren':
                 return function_call()
         raise ErioSyntaxError(token)
 
@@ -143,9 +285,9 @@ def parse(stream):
         next_token() #identifier
         next_token() #open-paren
         args = []
-        while token.type != 'close-paren':
+        while kind != 'close-paren':
             args.append(expr())
-            if token.type == 'comma':
+            if kind == 'comma':
                 next_token() #comma
         next_token() #close-paren
         return FunctionCall(name, args)
@@ -156,14 +298,14 @@ def parse(stream):
         next_token() #identifier
         next_token() #open-paren
         args = []
-        while token.type != 'close-paren':
+        while kind != 'close-paren':
             args.append(token)
             next_token() #identifier
-            if token.type == 'comma':
+            if kind == 'comma':
                 next_token() #comma
         next_token() #close-paren
         body = []
-        while token.type != 'end-def':
+        while kind != 'end-def':
             body.append(statement())
         next_token() #end-def
         return FunctionDef(name, args, body)
@@ -177,12 +319,12 @@ def parse(stream):
         cond = expr()
         next_token() #then
         then = []
-        while token.type not in ('else', 'end-if'):
+        while kind not in ('else', 'end-if'):
             then.append(statement())
         els = []
-        if token.type == 'else':
+        if kind == 'else':
             next_token() #else
-            while token.type != 'end-if':
+            while kind != 'end-if':
                 els.append(statement())
         next_token() #end-if
         return IfStmnt(cond, then, els)
@@ -192,7 +334,7 @@ def parse(stream):
         cond = expr()
         next_token() #do
         do = []
-        while token.type != 'end-while':
+        while kind != 'end-while':
             do.append(statement())
         next_token() #end-while
         return WhileStmnt(cond, do)
@@ -204,66 +346,73 @@ def parse(stream):
         value = expr()
         return AssignmentStmnt(var, value)
 
-    def expr():
-        def make_left_assoc_binary_op(expr_type, next_expr, token_types):
-            def binary_op():
-                def build_tree(lhs):
-                    if token.type not in token_types:
-                        return lhs
-                    op = token
-                    next_token() #op keyword
-                    exp = expr_type(op, lhs, next_expr())
-                    return build_tree(exp)
-                return build_tree(next_expr())
-            return binary_op
-
-        def make_prefix_unary_op(expr_type, next_expr, token_types):
-            def unary_op():
-                op_token_list = []
-                while token.type in token_types:
-                    op = token
-                    next_token() #op keyword
-                    op_token_list.append(op)
-                exp = next_expr()
-                for op in reversed(op_token_list):
-                    exp = expr_type(op, exp)
-                return exp
-            return unary_op
-
-        sign_expr = make_prefix_unary_op(
-            SignExpr, atom, ('add', 'sub'))
-        mul_expr = make_left_assoc_binary_op(
-            MulExpr, sign_expr, ('mul', 'div', 'mod'))
-        add_expr = make_left_assoc_binary_op(
-            AddExpr, mul_expr, ('add', 'sub'))
-        comp_expr = make_left_assoc_binary_op(
-            CompExpr, add_expr, ('eq', 'gt', 'lt', 'gteq', 'lteq', 'noteq'))
-        not_expr = make_prefix_unary_op(
-            NotExpr, comp_expr, ('not'))
-        and_expr = make_left_assoc_binary_op(
-            AndExpr, not_expr, ('and'))
-        or_expr = make_left_assoc_binary_op(
-            OrExpr, and_expr, ('or'))
-        return or_expr()
+    sign_types = frozenset(('add', 'sub'))
+
+    def sign_expr():
+        op_token_list = []
+        while kind in sign_types:
+            op_token_list.append(token)
+            next_token() #sign
+        exp = atom()
+        for op in reversed(op_token_list):
+            exp = SignExpr(op, exp)
+        return exp
+
+    def not_expr():
+        op_token_list = []
+        while kind == 'not':
+            op_token_list.append(token)
+            next_token() #not
+        exp = binary_expr(NOT_PRECEDENCE + 1)
+        for op in reversed(op_token_list):
+            exp = NotExpr(op, exp)
+        return exp
+
+    def binary_expr(min_precedence):
+        '''Parses operators binding at least as tightly as min_precedence by
+        precedence climbing, so a single loop covers every binary operator
+        level'''
+        if kind in sign_types:
+            lhs = sign_expr()
+        elif kind == 'not' and min_precedence <= NOT_PRECEDENCE:
+            lhs = not_expr()
+        else:
+            lhs = atom()
+        while True:
+            precedence = binary_precedence.get(kind)
+            if precedence is None or precedence < min_precedence:
+                return lhs
+            op = token
+            next_token() #op keyword
+            #Parsing the rhs one level tighter makes operators left
+            #associative
+            lhs = binary_exprs[op.type](op, lhs, binary_expr(precedence + 1))
 
     def atom():
-        if token.type in ('string', 'integer', 'boolean'):
+        if kind in ('string', 'integer', 'boolean'):
             return constant_expr()
-        elif token.type == 'identifier':
-            if lookahead.type == 'open-paren':
+        elif kind == 'identifier':
+            if next_kind == 'open-paren':
                 return function_call()
             else:
                 return variable_expr()
-        elif token.type == 'open-bracket':
+        elif kind == 'open-bracket':
             return sequence_expr()
-        elif token.type == 'open-paren':
+        elif kind == 'open-paren':
             return enclosure_expr()
         raise ErioSyntaxError(token)
 
     def constant_expr():
+        #Constants are converted to their runtime value once, here, rather
+        #than every time they are evaluated.
         val = token
         next_token() #constant
-        return ConstantExpr(val)
+        if val.type == 'integer':
+            return ConstantExpr(Integer(int(val.value)))
+        elif val.type == 'string':
+            #Strip the quotes off the string
+            return ConstantExpr(String(val.value[1:-1]))
+        return ConstantExpr(TRUE if val.value == 'true' else FALSE)
 
     def variable_expr():
         val = token
@@ -273,9 +422,9 @@ def parse(stream):
     def sequence_expr():
         next_token() #open-bracket
         elements = []
-        while token.type != 'close-bracket':
+        while kind != 'close-bracket':
             elements.append(expr())
-            if token.type == 'comma':
+            if kind == 'comma':
                 next_token() #comma
         next_token() #close-bracket
         return SequenceExpr(elements)
@@ -286,37 +435,352 @@ def parse(stream):
         next_token() #close-paren
         return exp
 
-    while token.type != 'eof':
-        yield top_level_statement()
+    #The grammar never backtracks, so there is nothing for a memo table to
+    #save. A lone constant or variable, the most common expression, skips the
+    #operator parsing altogether.
+    simple_atoms = frozenset(('string', 'integer', 'boolean', 'identifier'))
+    continuations = frozenset(binary_precedence).union(('open-paren',))
+    def expr():
+        if kind in simple_atoms and next_kind not in continuations:
+            if kind == 'identifier':
+                return variable_expr()
+            return constant_expr()
+        return binary_expr(1)
 
-Integer = namedtuple('Integer', 'val')
-String = namedtuple('String', 'val')
-Boolean = namedtuple('Boolean', 'val')
-Sequence = namedtuple('Sequence', 'val')
-Function = namedtuple('Function', ('env', 'args', 'body'))
+    while kind != 'eof':
+        yield top_level_statement()
 
-class Namespace(dict):
-    def __init__(self, *args, parent=None):
-        super().__init__(*args)
+def resolve_function(func_def):
+    '''Gives every argument and local variable of a function a slot in its
+    call frame, and rewrites the body to refer to its locals by slot'''
+
+    #Arguments take the first slots, in order, so the evaluated arguments of a
+    #call can be used as the start of the frame as they are.
+    slots = {}
+    for i, arg in enumerate(func_def.args):
+        slots[arg.value] = i
+    size = len(func_def.args)
+    #Whether the body defines functions of its own, which keep its frame
+    nested = False
+
+    def collect(block):
+        nonlocal size, nested
+        for s in block:
+            if isinstance(s, (AssignmentStmnt, FunctionDef)):
+                if s.id.value not in slots:
+                    slots[s.id.value] = size
+                    size += 1
+                if isinstance(s, FunctionDef):
+                    nested = True
+            elif isinstance(s, IfStmnt):
+                collect(s.then)
+                collect(s.els)
+            elif isinstance(s, WhileStmnt):
+                collect(s.do)
+
+    def block(stmnts):
+        return [statement(s) for s in stmnts]
+
+    def statement(s):
+        t = type(s)
+        if t is AssignmentStmnt:
+            return LocalAssignmentStmnt(slots[s.id.value], s.id, expr(s.expr))
+        elif t is IfStmnt:
+            return IfStmnt(expr(s.cond), block(s.then), block(s.els))
+        elif t is WhileStmnt:
+            return WhileStmnt(expr(s.cond), block(s.do))
+        elif t is ReturnStmnt:
+            return ReturnStmnt(expr(s.value))
+        elif t is FunctionCall:
+            return expr(s)
+        elif t is FunctionDef:
+            return resolve_function(s)
+        return s
+
+    def expr(e):
+        t = type(e)
+        if t is VariableExpr:
+            slot = slots.get(e.id.value)
+            return e if slot is None else LocalVariableExpr(slot, e.id)
+        elif t is FunctionCall:
+            return FunctionCall(e.id, [expr(a) for a in e.args])
+        elif t is SequenceExpr:
+            return SequenceExpr([expr(v) for v in e.value])
+        elif t in (NotExpr, SignExpr):
+            return t(e.op, expr(e.rhs))
+        elif t in binary_nodes:
+            spine = []
+            while type(e) in binary_nodes:
+                spine.append(e)
+                e = e.lhs
+            lhs = expr(e)
+            for node in reversed(spine):
+                lhs = type(node)(node.op, lhs, expr(node.rhs))
+            return lhs
+        return e
+
+    collect(func_def.body)
+    return ResolvedFunctionDef(func_def.id,
+                               [token.value for token in func_def.args],
+                               block(func_def.body), slots, size, nested)
+
+#Native code works on 64 bit integers, so it is only used while every value
+#fits in one
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+#Arithmetic used by native functions. Each one raises OverflowError instead of
+#wrapping around, so the result is either exact or thrown away. The checks
+#never compute an overflowing value themselves, as the compiler is free to
+#assume that signed arithmetic does not overflow.
+def _native_add(a, b):
+    if (b > 0 and a > INT64_MAX - b) or (b < 0 and a < INT64_MIN - b):
+        raise OverflowError
+    return a + b
+
+def _native_sub(a, b):
+    if (b < 0 and a > INT64_MAX + b) or (b > 0 and a < INT64_MIN + b):
+        raise OverflowError
+    return a - b
+
+def _native_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    if a == INT64_MIN or b == INT64_MIN:
+        if a == 1 or b == 1:
+            return a * b
+        raise OverflowError
+    #This also gives up on the one negative product that would fit, INT64_MIN
+    if abs(a) > INT64_MAX // abs(b):
+        raise OverflowError
+    return a * b
+
+def _native_div(a, b):
+    if b == -1:
+        if a == INT64_MIN:
+            raise OverflowError
+        return -a
+    return a // b
+
+def _native_mod(a, b):
+    if b == -1:
+        return 0
+    return a % b
+
+def _native_neg(a):
+    if a == INT64_MIN:
+        raise OverflowError
+    return -a
+
+#Number of calls after which a function is compiled to machine code
+NATIVE_CALL_THRESHOLD = 1000
+
+@functools.lru_cache(maxsize=None)
+def native_support():
+    '''Imports numba, which is slow to import, the first time a function is
+    compiled. Returns the compiler, the globals that native functions use and
+    the errors that make a call fall back to the bytecode, or None if numba is
+    not installed'''
+    try:
+        import numba
+    except ImportError:
+        return None
+    helpers = {
+        'add':      numba.njit(_native_add),
+        'sub':      numba.njit(_native_sub),
+        'mul':      numba.njit(_native_mul),
+        'div':      numba.njit(_native_div),
+        'mod':      numba.njit(_native_mod),
+        'neg':      numba.njit(_native_neg)}
+    errors = (OverflowError, ZeroDivisionError, numba.core.errors.NumbaError)
+    return numba.njit, helpers, errors
+
+def native_function(func_def):
+    '''Compiles a resolved function to machine code with numba, if numba is
+    installed and the function only does integer arithmetic on its own
+    locals. Returns None for any other function.
+
+    The result takes the list of argument values of a call and returns the
+    returned value, or None when the call has to run as bytecode instead:
+    until the function has been called NATIVE_CALL_THRESHOLD times, when an
+    argument is not an integer that fits in 64 bits, or when the native code
+    overflows or raises. Native functions do nothing but arithmetic, so
+    running the bytecode after them gives the same result and errors.'''
+
+    class Unsupported(Exception): pass
+
+    lines = ['def native({}):'.format(
+        ', '.join('v{}'.format(i) for i in range(len(func_def.args))))]
+    #Locals that are certainly assigned at this point. Reading any other local
+    #would fall back to an outer scope, which native code cannot do.
+    assigned = set(range(len(func_def.args)))
+
+    def block(stmnts, indent):
+        if not stmnts:
+            lines.append(indent + 'pass')
+        for s in stmnts:
+            statement(s, indent)
+
+    def statement(s, indent):
+        nonlocal assigned
+        t = type(s)
+        if t is LocalAssignmentStmnt:
+            lines.append('{}v{} = {}'.format(indent, s.slot, int_expr(s.expr)))
+            assigned.add(s.slot)
+        elif t is IfStmnt:
+            lines.append('{}if {}:'.format(indent, bool_expr(s.cond)))
+            outer = assigned
+            assigned = set(outer)
+            block(s.then, indent + '    ')
+            lines.append(indent + 'else:')
+            assigned = set(outer)
+            block(s.els, indent + '    ')
+            assigned = outer
+        elif t is WhileStmnt:
+            lines.append('{}while {}:'.format(indent, bool_expr(s.cond)))
+            outer = assigned
+            assigned = set(outer)
+            block(s.do, indent + '    ')
+            assigned = outer
+        elif t is ReturnStmnt:
+            lines.append('{}return {}'.format(indent, int_expr(s.value)))
+        else:
+            raise Unsupported
+
+    def int_expr(e):
+        t = type(e)
+        if t is ConstantExpr and type(e.value) is Integer \
+                and INT64_MIN <= e.value.val <= INT64_MAX:
+            return str(e.value.val)
+        elif t is LocalVariableExpr and e.slot in assigned:
+            return 'v{}'.format(e.slot)
+        elif t is AddExpr or t is MulExpr:
+            #The checked arithmetic helpers are named after the operator
+            return '{}({}, {})'.format(e.op.type, int_expr(e.lhs),
+                                       int_expr(e.rhs))
+        elif t is SignExpr and e.op.type == 'sub':
+            return 'neg({})'.format(int_expr(e.rhs))
+        elif t is SignExpr:
+            return int_expr(e.rhs)
+        raise Unsupported
+
+    def bool_expr(e):
+        t = type(e)
+        if t is ConstantExpr and type(e.value) is Boolean:
+            return str(e.value.val)
+        elif t is CompExpr:
+            return '({} {} {})'.format(int_expr(e.lhs), native_ops[e.op.type],
+                                       int_expr(e.rhs))
+        elif t is AndExpr or t is OrExpr:
+            return '({} {} {})'.format(bool_expr(e.lhs), e.op.value,
+                                       bool_expr(e.rhs))
+        elif t is NotExpr:
+            return '(not {})'.format(bool_expr(e.rhs))
+        raise Unsupported
+
+    #Every path has to end in a return, so that an int is always returned
+    if not func_def.body or type(func_def.body[-1]) is not ReturnStmnt:
+        return None
+    #Expressions nested too deeply to translate, or for Python to compile,
+    #are left to the bytecode
+    try:
+        block(func_def.body, '    ')
+        source = compile('\n'.join(lines), '<native>', 'exec')
+    except (Unsupported, RecursionError, SyntaxError, MemoryError):
+        return None
+
+    #Importing numba and compiling take far longer than running most
+    #functions, so only functions which are called often are compiled.
+    #native is None until then, and False if numba is not installed.
+    calls = 0
+    native = None
+    errors = ()
+
+    def compile_native():
+        nonlocal errors
+        support = native_support()
+        if support is None:
+            return False
+        njit, helpers, errors = support
+        namespace = dict(helpers)
+        exec(source, namespace)
+        return njit(namespace['native'])
+
+    def call(args):
+        nonlocal calls, native
+        if native is None:
+            calls += 1
+            if calls < NATIVE_CALL_THRESHOLD:
+                return None
+            native = compile_native()
+        if native is False:
+            return None
+        vals = []
+        for a in args:
+            if type(a) is not Integer or not INT64_MIN <= a.val <= INT64_MAX:
+                return None
+            vals.append(a.val)
+        try:
+            return Integer(native(*vals))
+        except errors:
+            return None
+    return call
+
+#Python comparison operators used by native_function for each token type
+native_ops = {
+    'eq':       '==',
+    'lt':       '<',
+    'gt':       '>',
+    'lteq':     '<=',
+    'gteq':     '>=',
+    'noteq':    '!='}
+
+#The operator behind each operator token type
+comparison_ops = {
+    'eq':       operator.eq,
+    'lt':       operator.lt,
+    'gt':       operator.gt,
+    'lteq':     operator.le,
+    'gteq':     operator.ge,
+    'noteq':    operator.ne}
+arithmetic_ops = {
+    'add':      operator.add,
+    'sub':      operator.sub,
+    'mul':      operator.mul,
+    'div':      operator.floordiv,
+    'mod':      operator.mod}
+sign_ops = {
+    'add':      operator.pos,
+    'sub':      operator.neg}
+
+
+_missing = object()
+
+class Frame:
+    '''The scope of a single call to a user defined function. Arguments and
+    local variables are kept in a list, at the slots given to them by
+    resolve_function. Any other name is looked up in the parent scope.'''
+
+    __slots__ = ('values', 'locals', 'parent')
+
+    def __init__(self, values, locals, parent):
+        self.values = values
+        self.locals = locals
         self.parent = parent
 
     def __getitem__(self, key):
-        if not super().__contains__(key) \
-                and self.parent != None and key in self.parent:
-            return self.parent[key]
-        return super().__getitem__(key)
-
-    def __contains__(self, key):
-        found_here = super().__contains__(key)
-        if not found_here \
-                and self.parent != None and key in self.parent:
-            return True
-        return found_here
+        slot = self.locals.get(key)
+        if slot is not None:
+            value = self.values[slot]
+            if value is not _missing:
+                return value
+        return self.parent[key]
 
 def build_global_environment(out):
-    env = Namespace()
-    env['.out'] = out
+    env = {}
 
+    #Primitives are called directly with their evaluated arguments, without
+    #building a scope for them
     def primitive_function(name, argnames):
         def decor(original_func):
             env[name] = Function(env, argnames, original_func)
@@ -324,203 +788,310 @@ def build_global_environment(out):
         return decor
 
     @primitive_function('print', ['s'])
-    def _print(runenv):
-        s = ''
-        if isinstance(runenv['s'], Boolean):
-            s = 'true' if runenv['s'].val else 'false'
+    def _print(s):
+        if isinstance(s, Boolean):
+            out.write('true' if s.val else 'false')
         else:
-            s = str(runenv['s'].val)
-        runenv['.out'].write(s)
+            out.write(str(s.val))
 
     @primitive_function('add', ['lhs', 'rhs'])
-    def _add(runenv):
-        return Integer(runenv['lhs'].val + runenv['rhs'].val)
+    def _add(lhs, rhs):
+        return Integer(lhs.val + rhs.val)
 
     @primitive_function('sub', ['lhs', 'rhs'])
-    def _sub(runenv):
-        return Integer(runenv['lhs'].val - runenv['rhs'].val)
+    def _sub(lhs, rhs):
+        return Integer(lhs.val - rhs.val)
 
     @primitive_function('lt', ['lhs', 'rhs'])
-    def _lt(runenv):
-        return Boolean(runenv['lhs'].val < runenv['rhs'].val)
+    def _lt(lhs, rhs):
+        return TRUE if lhs.val < rhs.val else FALSE
 
     @primitive_function('eq', ['lhs', 'rhs'])
-    def _eq(runenv):
-        return Boolean(runenv['lhs'].val == runenv['rhs'].val)
+    def _eq(lhs, rhs):
+        return TRUE if lhs.val == rhs.val else FALSE
 
     @primitive_function('geti', ['seq', 'i'])
-    def _geti(runenv):
-        return runenv['seq'].val[runenv['i'].val]
+    def _geti(seq, i):
+        return seq.val[i.val]
 
     @primitive_function('seti', ['seq', 'i', 'value'])
-    def _seti(runenv):
-        runenv['seq'].val[runenv['i'].val] = runenv['value']
+    def _seti(seq, i, value):
+        seq.val[i.val] = value
 
     @primitive_function('len', ['seq'])
-    def _len(runenv):
-        return Integer(len(runenv['seq'].val))
+    def _len(seq):
+        return Integer(len(seq.val))
 
     @primitive_function('insert', ['seq', 'i', 'value'])
-    def _insert(runenv):
-        runenv['seq'].val.insert(runenv['i'].val, runenv['value'])
+    def _insert(seq, i, value):
+        seq.val.insert(i.val, value)
 
     return env
 
-def execute(env, block):
-    def true(obj):
-        return obj.val == True
+#Opcodes of the virtual machine. Each instruction is an (opcode, argument)
+#tuple and jump arguments are indexes into the instruction list.
+(LOAD_CONST, LOAD_NAME, LOAD_LOCAL, STORE_NAME, STORE_LOCAL, BINARY_OP,
+ COMPARE_OP, SIGN_OP, NOT, BUILD_SEQUENCE, CALL, POP_TOP, JUMP,
+ POP_JUMP_IF_FALSE, JUMP_IF_TRUE_OR_POP, MAKE_FUNCTION,
+ RETURN_VALUE) = range(17)
 
-    def exec_block(block):
-        #ret might hold the return value for a function. We jump out of the
-        #block if that happens.
-        for s in block:
-            ret = exec_statement(s)
-            if ret: return ret
-
-    def exec_statement(statement):
-        #if and while can cause functions to return if they contain 'return's
-        #themselves. Other statements (besides return itself) cannot do this.
-        ret = None
-        if isinstance(statement, IfStmnt):
-            ret = exec_if(statement)
-        elif isinstance(statement, WhileStmnt):
-            ret = exec_while(statement)
-        elif isinstance(statement, ReturnStmnt):
-            ret = exec_return(statement)
-        elif isinstance(statement, AssignmentStmnt):
-            exec_assign(statement)
-        elif isinstance(statement, FunctionCall):
-            eval_func_call(statement)
-        elif isinstance(statement, FunctionDef):
-            exec_func_def(statement)
-        return ret
-
-    def exec_if(statement):
-        if true(eval_expr(statement.cond)):
-            ret = exec_block(statement.then)
-            if ret: return ret
+def compile_block(block, locals=None):
+    '''Compiles a block of statements to a tuple of instructions. locals maps
+    the local variables of the function being compiled to their slots, and is
+    None at the top level where every variable is looked up by name.'''
+
+    code = []
+
+    def emit(op, arg=None):
+        code.append((op, arg))
+        return len(code) - 1
+
+    def patch(index, target):
+        code[index] = (code[index][0], target)
+
+    def store(name):
+        if locals is None:
+            emit(STORE_NAME, name)
         else:
-            ret = exec_block(statement.els)
-            if ret: return ret
-
-    def exec_while(statement):
-        while true(eval_expr(statement.cond)):
-            ret = exec_block(statement.do)
-            if ret: return ret
-
-    def exec_assign(statement):
-        env[statement.id.value] = eval_expr(statement.expr)
-
-    def exec_func_def(func_def):
-        name = func_def.id.value
-        args = [token.value for token in func_def.args]
-        def func(runenv):
-            return execute(runenv, func_def.body)
-        env[name] = Function(env, args, func)
-
-    def exec_return(statement):
-        return eval_expr(statement.value)
-
-    def eval_expr(expr):
-        if isinstance(expr, ConstantExpr):
-            return eval_const(expr.value)
-        elif isinstance(expr, VariableExpr):
-            return eval_var(expr.id)
-        elif isinstance(expr, SequenceExpr):
-            return eval_seq(expr.value)
-        elif isinstance(expr, OrExpr):
-            return eval_or(expr)
-        elif isinstance(expr, AndExpr):
-            return eval_and(expr)
-        elif isinstance(expr, NotExpr):
-            return eval_not(expr)
-        elif isinstance(expr, CompExpr):
-            return eval_comp(expr)
-        elif isinstance(expr, (MulExpr, AddExpr)):
-            return eval_arith(expr)
-        elif isinstance(expr, SignExpr):
-            return eval_sign(expr)
-        elif isinstance(expr, FunctionCall):
-            return eval_func_call(expr)
+            emit(STORE_LOCAL, locals[name])
+
+    def statement(s):
+        t = type(s)
+        if t is AssignmentStmnt:
+            expr(s.expr)
+            emit(STORE_NAME, s.id.value)
+        elif t is LocalAssignmentStmnt:
+            expr(s.expr)
+            emit(STORE_LOCAL, s.slot)
+        elif t is IfStmnt:
+            expr(s.cond)
+            jump_else = emit(POP_JUMP_IF_FALSE)
+            for then in s.then:
+                statement(then)
+            if s.els:
+                jump_end = emit(JUMP)
+                patch(jump_else, len(code))
+                for els in s.els:
+                    statement(els)
+                patch(jump_end, len(code))
+            else:
+                patch(jump_else, len(code))
+        elif t is WhileStmnt:
+            start = len(code)
+            expr(s.cond)
+            jump_end = emit(POP_JUMP_IF_FALSE)
+            for do in s.do:
+                statement(do)
+            emit(JUMP, start)
+            patch(jump_end, len(code))
+        elif t is ReturnStmnt:
+            expr(s.value)
+            emit(RETURN_VALUE)
+        elif t is FunctionCall:
+            expr(s)
+            emit(POP_TOP)
+        elif t is FunctionDef or t is ResolvedFunctionDef:
+            if t is FunctionDef:
+                s = resolve_function(s)
+            emit(MAKE_FUNCTION, (s.args, compile_block(s.body, s.locals),
+                                 s.locals, s.size, native_function(s),
+                                 s.nested))
+            store(s.id.value)
         else:
-            raise ErioRuntimeError('Invalid expression: {}'.format(expr))
-
-    def eval_or(expr):
-        lhs = eval_expr(expr.lhs)
-        if true(lhs):
-            return lhs
-        rhs = eval_expr(expr.rhs)
-        if true(rhs):
-            return rhs
-        return Boolean(False)
-
-    def eval_and(expr):
-        lhs = eval_expr(expr.lhs)
-        if not true(lhs):
-            return Boolean(False)
-        rhs = eval_expr(expr.rhs)
-        if not true(rhs):
-            return Boolean(False)
-        return rhs
-
-    def eval_not(expr):
-        return Boolean(not true(eval_expr(expr.rhs)))
-
-    def eval_comp(expr):
-        ops = {
-            'eq':       operator.eq,
-            'lt':       operator.lt,
-            'gt':       operator.gt,
-            'lteq':     operator.le,
-            'gteq':     operator.ge,
-            'noteq':    operator.ne}
-        lhs = eval_expr(expr.lhs).val
-        rhs = eval_expr(expr.rhs).val
-        return Boolean(ops[expr.op.type](lhs, rhs))
-
-    def eval_arith(expr):
-        ops = {
-            'add':  operator.add,
-            'sub':  operator.sub,
-            'mul':  operator.mul,
-            'div':  operator.floordiv,
-            'mod':  operator.mod}
-        lhs = eval_expr(expr.lhs).val
-        rhs = eval_expr(expr.rhs).val
-        return Integer(ops[expr.op.type](lhs, rhs))
-
-    def eval_sign(expr):
-        ops = {
-            'add':  operator.pos,
-            'sub':  operator.neg}
-        rhs = eval_expr(expr.rhs).val
-        return Integer(ops[expr.op.type](rhs))
-
-    def eval_func_call(func_call):
-        func = env[func_call.id.value]
-        evald_args = [eval_expr(a) for a in func_call.args]
-        runenv = Namespace(parent=func.env)
-        runenv.update(zip(func.args, evald_args))
-        return func.body(runenv)
-
-    def eval_const(token):
-        if token.type == 'string':
-            #Strip the quotes off the string before returning it
-            return String(token.value[1:-1])
-        elif token.type == 'integer':
-            return Integer(int(token.value))
-        elif token.type == 'boolean':
-            return Boolean(token.value == 'true')
+            raise ErioRuntimeError('Invalid statement: {}'.format(s))
+
+    def expr(e):
+        t = type(e)
+        if t is ConstantExpr:
+            emit(LOAD_CONST, e.value)
+        elif t is LocalVariableExpr:
+            emit(LOAD_LOCAL, (e.slot, e.id.value))
+        elif t is VariableExpr:
+            emit(LOAD_NAME, e.id.value)
+        elif t in binary_nodes:
+            spine = []
+            while type(e) in binary_nodes:
+                spine.append(e)
+                e = e.lhs
+            expr(e)
+            for node in reversed(spine):
+                binary_op(node)
+        elif t is FunctionCall:
+            for a in e.args:
+                expr(a)
+            emit(CALL, (e.id.value, len(e.args)))
+        elif t is NotExpr:
+            expr(e.rhs)
+            emit(NOT)
+        elif t is SignExpr:
+            expr(e.rhs)
+            emit(SIGN_OP, sign_ops[e.op.type])
+        elif t is SequenceExpr:
+            for v in e.value:
+                expr(v)
+            emit(BUILD_SEQUENCE, len(e.value))
         else:
-            raise ErioRuntimeError('Invalid constant token: {}'.format(token))
-
-    def eval_var(token):
-        return env[token.value]
+            raise ErioRuntimeError('Invalid expression: {}'.format(e))
+
+    def binary_op(e):
+        '''Compiles the rest of a binary expression once its lhs is on the
+        stack'''
+        t = type(e)
+        if t is AddExpr or t is MulExpr:
+            expr(e.rhs)
+            emit(BINARY_OP, arithmetic_ops[e.op.type])
+        elif t is CompExpr:
+            expr(e.rhs)
+            emit(COMPARE_OP, comparison_ops[e.op.type])
+        elif t is OrExpr:
+            #Leaves the first true operand on the stack, or false
+            jump_lhs = emit(JUMP_IF_TRUE_OR_POP)
+            expr(e.rhs)
+            jump_rhs = emit(JUMP_IF_TRUE_OR_POP)
+            emit(LOAD_CONST, FALSE)
+            patch(jump_lhs, len(code))
+            patch(jump_rhs, len(code))
+        else:
+            #Leaves the second operand on the stack if both are true, or false
+            jump_false = emit(POP_JUMP_IF_FALSE)
+            expr(e.rhs)
+            jump_end = emit(JUMP_IF_TRUE_OR_POP)
+            patch(jump_false, len(code))
+            emit(LOAD_CONST, FALSE)
+            patch(jump_end, len(code))
+
+    for s in block:
+        statement(s)
+    return tuple(code)
+
+def run(code, env):
+    '''Runs compiled code in env. Returns the value of the return statement
+    that ended it, if any.'''
+
+    values = env.values if type(env) is Frame else None
+    stack = []
+    push = stack.append
+    pop = stack.pop
+    pc = 0
+    end = len(code)
+    #The most common instructions are tested first
+    while pc < end:
+        op, arg = code[pc]
+        pc += 1
+        if op == LOAD_LOCAL:
+            value = values[arg[0]]
+            if value is _missing:
+                #Not assigned yet in this call, so it refers to an outer variable
+                value = env.parent[arg[1]]
+            push(value)
+        elif op == LOAD_CONST:
+            push(arg)
+        elif op == BINARY_OP:
+            rhs = pop()
+            push(Integer(arg(pop().val, rhs.val)))
+        elif op == STORE_LOCAL:
+            values[arg] = pop()
+        elif op == POP_JUMP_IF_FALSE:
+            if pop().val != True:
+                pc = arg
+        elif op == COMPARE_OP:
+            rhs = pop()
+            push(TRUE if arg(pop().val, rhs.val) else FALSE)
+        elif op == JUMP:
+            pc = arg
+        elif op == CALL:
+            name, nargs = arg
+            func = env[name]
+            #Calls with one or two arguments are by far the most common
+            if nargs == 1:
+                args = [pop()]
+            elif nargs == 2:
+                rhs = pop()
+                args = [pop(), rhs]
+            elif nargs:
+                args = stack[-nargs:]
+                del stack[-nargs:]
+            else:
+                args = []
+            nparams = len(func.args)
+            if func.locals is None:
+                if nargs != nparams:
+                    raise ErioRuntimeError('{} takes {} arguments'.format(
+                        name, nparams))
+                push(func.body(*args))
+                continue
+            if func.native is not None and nargs == nparams:
+                ret = func.native(args)
+                if ret is not None:
+                    push(ret)
+                    continue
+            #The frame starts with the arguments, followed by the unassigned
+            #locals
+            if nargs != nparams:
+                args = (args + [_missing] * nparams)[:nparams]
+            if func.size != nparams:
+                args += [_missing] * (func.size - nparams)
+            frame = func.frame
+            if frame is not None and frame.values is None:
+                #Reuse the function's own frame unless it is already running
+                frame.values = args
+                try:
+                    push(run(func.body, frame))
+                finally:
+                    frame.values = None
+            else:
+                push(run(func.body, Frame(args, func.locals, func.env)))
+        elif op == LOAD_NAME:
+            push(env[arg])
+        elif op == STORE_NAME:
+            env[arg] = pop()
+        elif op == POP_TOP:
+            pop()
+        elif op == RETURN_VALUE:
+            return pop()
+        elif op == JUMP_IF_TRUE_OR_POP:
+            if stack[-1].val == True:
+                pc = arg
+            else:
+                pop()
+        elif op == NOT:
+            push(FALSE if pop().val == True else TRUE)
+        elif op == SIGN_OP:
+            push(Integer(arg(pop().val)))
+        elif op == BUILD_SEQUENCE:
+            if arg:
+                elems = stack[-arg:]
+                del stack[-arg:]
+            else:
+                elems = []
+            push(Sequence(elems))
+        elif op == MAKE_FUNCTION:
+            args, body, locals, size, native, nested = arg
+            #A function that defines no functions of its own never leaves a
+            #reference to its frame behind, so one frame can serve its calls
+            frame = None if nested else Frame(None, locals, env)
+            push(Function(env, args, body, locals, size, native, frame))
+        else:
+            raise ErioRuntimeError('Invalid instruction: {}'.format(op))
 
-    def eval_seq(elems):
-        return Sequence([eval_expr(e) for e in elems])
+@functools.lru_cache(maxsize=128)
+def compile_source(source):
+    '''Tokenizes, parses and compiles every top level statement of source.
+    Compiled code is never modified, so the result is cached and shared by
+    every run of the same source.'''
+    return tuple(compile_block((s,)) for s in parse(tokenize(source)))
 
-    return exec_block(block)
+def execute(env, block):
+    '''Compiles and runs each top level statement of block as soon as it has
+    been parsed. block may also be source text, which is compiled up front by
+    compile_source.'''
+    if isinstance(block, str):
+        program = compile_source(block)
+    else:
+        program = (compile_block((s,)) for s in block)
+    for code in program:
+        ret = run(code, env)
+        if ret: return ret
 
 def exec_to_string(block):
     out = io.StringIO()
@@ -536,15 +1107,25 @@ def exec_to_stdout(block):
     execute(env, block)
 
 def interpreter(instream, outstream):
-    def by_char(stream):
-        for line in stream:
-            for char in line:
-                yield char
     env = build_global_environment(outstream)
-    execute(env, parse(tokenize(by_char(instream))))
+    if instream.isatty():
+        #No token spans a line break, so an interactive session is tokenized a
+        #line at a time and each statement runs as soon as it has been typed.
+        tokens = (token for line in instream for token in tokenize(line))
+    else:
+        tokens = tokenize(instream.read())
+    execute(env, parse(tokens))
 
 def erio(text):
-    exec_to_stdout(parse(tokenize(text)))
+    exec_to_stdout(text)
+
+#Use the compiled scanner and virtual machine loop when they have been built
+try:
+    import erio_core
+except ImportError:
+    pass
+else:
+    tokenize, run = erio_core.bind(globals())
 
 if __name__ == '__main__':
     interpreter(sys.stdin, sys.stdout)
@@ -0,0 +1,244 @@
+# cython: language_level=3
+'''Cython versions of the erio scanner and virtual machine loop.
+
+Build the extension in place with 'python setup.py build_ext --inplace'.
+When it can be imported, erio binds it to its own tables and types and uses
+it in place of the pure Python tokenize and run. Both have to behave exactly
+like the Python versions in erio.py.'''
+
+import sys
+
+cdef object Token, TOKEN_TABLE, TWO_CHAR_SYMBOLS, ErioInvalidTokenError
+cdef object Integer, Sequence, Function, Frame
+cdef object ErioRuntimeError, _missing, TRUE, FALSE
+cdef bytes CHAR_CLASS
+cdef const unsigned char *char_class
+cdef int INVALID, WHITESPACE, QUOTE, OPERATOR, OPERATOR_PREFIX, ALPHA, DIGIT
+cdef int LOAD_CONST, LOAD_NAME, LOAD_LOCAL, STORE_NAME, STORE_LOCAL, BINARY_OP
+cdef int COMPARE_OP, SIGN_OP, NOT, BUILD_SEQUENCE, CALL, POP_TOP, JUMP
+cdef int POP_JUMP_IF_FALSE, JUMP_IF_TRUE_OR_POP, MAKE_FUNCTION, RETURN_VALUE
+
+def bind(namespace):
+    '''Takes the tables and types used by tokenize and run from the erio
+    module namespace, and returns the two functions'''
+    global Token, TOKEN_TABLE, TWO_CHAR_SYMBOLS, ErioInvalidTokenError
+    global Integer, Sequence, Function, Frame
+    global ErioRuntimeError, _missing, TRUE, FALSE, CHAR_CLASS, char_class
+    global INVALID, WHITESPACE, QUOTE, OPERATOR, OPERATOR_PREFIX, ALPHA, DIGIT
+    global LOAD_CONST, LOAD_NAME, LOAD_LOCAL, STORE_NAME, STORE_LOCAL
+    global BINARY_OP, COMPARE_OP, SIGN_OP, NOT, BUILD_SEQUENCE, CALL, POP_TOP
+    global JUMP, POP_JUMP_IF_FALSE, JUMP_IF_TRUE_OR_POP, MAKE_FUNCTION
+    global RETURN_VALUE
+
+    Token = namespace['Token']
+    TOKEN_TABLE = namespace['TOKEN_TABLE']
+    TWO_CHAR_SYMBOLS = namespace['TWO_CHAR_SYMBOLS']
+    ErioInvalidTokenError = namespace['ErioInvalidTokenError']
+    Integer = namespace['Integer']
+    Sequence = namespace['Sequence']
+    Function = namespace['Function']
+    Frame = namespace['Frame']
+    ErioRuntimeError = namespace['ErioRuntimeError']
+    _missing = namespace['_missing']
+    TRUE = namespace['TRUE']
+    FALSE = namespace['FALSE']
+    CHAR_CLASS = namespace['CHAR_CLASS']
+    char_class = CHAR_CLASS
+
+    INVALID = namespace['INVALID']
+    WHITESPACE = namespace['WHITESPACE']
+    QUOTE = namespace['QUOTE']
+    OPERATOR = namespace['OPERATOR']
+    OPERATOR_PREFIX = namespace['OPERATOR_PREFIX']
+    ALPHA = namespace['ALPHA']
+    DIGIT = namespace['DIGIT']
+
+    LOAD_CONST = namespace['LOAD_CONST']
+    LOAD_NAME = namespace['LOAD_NAME']
+    LOAD_LOCAL = namespace['LOAD_LOCAL']
+    STORE_NAME = namespace['STORE_NAME']
+    STORE_LOCAL = namespace['STORE_LOCAL']
+    BINARY_OP = namespace['BINARY_OP']
+    COMPARE_OP = namespace['COMPARE_OP']
+    SIGN_OP = namespace['SIGN_OP']
+    NOT = namespace['NOT']
+    BUILD_SEQUENCE = namespace['BUILD_SEQUENCE']
+    CALL = namespace['CALL']
+    POP_TOP = namespace['POP_TOP']
+    JUMP = namespace['JUMP']
+    POP_JUMP_IF_FALSE = namespace['POP_JUMP_IF_FALSE']
+    JUMP_IF_TRUE_OR_POP = namespace['JUMP_IF_TRUE_OR_POP']
+    MAKE_FUNCTION = namespace['MAKE_FUNCTION']
+    RETURN_VALUE = namespace['RETURN_VALUE']
+    return tokenize, run
+
+cdef inline int classify(Py_UCS4 c):
+    #Above latin-1, any character but whitespace may be part of a word, which
+    #then has to be a valid identifier
+    if c < 256:
+        return char_class[c]
+    return WHITESPACE if c.isspace() else ALPHA
+
+cdef Py_ssize_t skip_word(str src, Py_ssize_t i, Py_ssize_t n):
+    while i < n and classify(src[i]) >= ALPHA:
+        i += 1
+    return i
+
+def tokenize(str src):
+    '''Creates a generator which returns the tokens from the source string'''
+
+    cdef Py_ssize_t i = 0, n = len(src), start, end
+    cdef Py_UCS4 c
+    cdef int cls
+    while i < n:
+        start = i
+        cls = classify(src[i])
+        if cls == WHITESPACE:
+            i += 1
+        elif cls == ALPHA:
+            i = skip_word(src, i + 1, n)
+            if i < n and src[i] == u'-' and src[start:i] == u'end':
+                i = skip_word(src, i + 1, n)
+            value = src[start:i]
+            token = TOKEN_TABLE.get(value)
+            if token is not None:
+                yield token
+            elif not value.isidentifier():
+                raise ErioInvalidTokenError(value)
+            else:
+                yield Token('identifier', sys.intern(value))
+        elif cls == OPERATOR:
+            i += 1
+            yield TOKEN_TABLE[src[start:i]]
+        elif cls == DIGIT:
+            i += 1
+            while i < n:
+                c = src[i]
+                if c < u'0' or c > u'9':
+                    break
+                i += 1
+            end = skip_word(src, i, n)
+            if end != i:
+                raise ErioInvalidTokenError(src[start:end])
+            yield Token('integer', src[start:i])
+        elif cls == OPERATOR_PREFIX:
+            if src[i:i + 2] in TWO_CHAR_SYMBOLS:
+                i += 2
+            else:
+                i += 1
+            token = TOKEN_TABLE.get(src[start:i])
+            if token is None:
+                raise ErioInvalidTokenError(src[start:i])
+            yield token
+        elif cls == QUOTE:
+            end = src.find(u'"', i + 1)
+            if end < 0:
+                raise ErioInvalidTokenError(src[start:])
+            i = end + 1
+            value = src[start:i]
+            if not value.isprintable():
+                raise ErioInvalidTokenError(value)
+            yield Token('string', value)
+        else:
+            raise ErioInvalidTokenError(src[i])
+
+def run(tuple code, env):
+    '''Runs compiled code in env. Returns the value of the return statement
+    that ended it, if any.'''
+
+    cdef list values = env.values if type(env) is Frame else None
+    cdef list stack = []
+    cdef list args
+    cdef Py_ssize_t pc = 0, end = len(code), nargs, nparams
+    cdef int op
+    while pc < end:
+        op, arg = <tuple>code[pc]
+        pc += 1
+        if op == LOAD_LOCAL:
+            value = values[arg[0]]
+            if value is _missing:
+                value = env.parent[arg[1]]
+            stack.append(value)
+        elif op == LOAD_CONST:
+            stack.append(arg)
+        elif op == BINARY_OP:
+            rhs = stack.pop()
+            stack.append(Integer(arg(stack.pop().val, rhs.val)))
+        elif op == STORE_LOCAL:
+            values[arg] = stack.pop()
+        elif op == POP_JUMP_IF_FALSE:
+            if stack.pop().val != True:
+                pc = arg
+        elif op == COMPARE_OP:
+            rhs = stack.pop()
+            stack.append(TRUE if arg(stack.pop().val, rhs.val) else FALSE)
+        elif op == JUMP:
+            pc = arg
+        elif op == CALL:
+            name, nargs = arg
+            func = env[name]
+            if nargs == 1:
+                args = [stack.pop()]
+            elif nargs == 2:
+                rhs = stack.pop()
+                args = [stack.pop(), rhs]
+            elif nargs:
+                args = stack[-nargs:]
+                del stack[-nargs:]
+            else:
+                args = []
+            nparams = len(func.args)
+            if func.locals is None:
+                if nargs != nparams:
+                    raise ErioRuntimeError('{} takes {} arguments'.format(
+                        name, nparams))
+                stack.append(func.body(*args))
+                continue
+            if func.native is not None and nargs == nparams:
+                ret = func.native(args)
+                if ret is not None:
+                    stack.append(ret)
+                    continue
+            if nargs != nparams:
+                args = (args + [_missing] * nparams)[:nparams]
+            if func.size != nparams:
+                args += [_missing] * (func.size - nparams)
+            frame = func.frame
+            if frame is not None and frame.values is None:
+                frame.values = args
+                try:
+                    stack.append(run(func.body, frame))
+                finally:
+                    frame.values = None
+            else:
+                stack.append(run(func.body, Frame(args, func.locals, func.env)))
+        elif op == LOAD_NAME:
+            stack.append(env[arg])
+        elif op == STORE_NAME:
+            env[arg] = stack.pop()
+        elif op == POP_TOP:
+            stack.pop()
+        elif op == RETURN_VALUE:
+            return stack.pop()
+        elif op == JUMP_IF_TRUE_OR_POP:
+            if stack[-1].val == True:
+                pc = arg
+            else:
+                stack.pop()
+        elif op == NOT:
+            stack.append(FALSE if stack.pop().val == True else TRUE)
+        elif op == SIGN_OP:
+            stack.append(Integer(arg(stack.pop().val)))
+        elif op == BUILD_SEQUENCE:
+            if arg:
+                elems = stack[-arg:]
+                del stack[-arg:]
+            else:
+                elems = []
+            stack.append(Sequence(elems))
+        elif op == MAKE_FUNCTION:
+            args, body, locals, size, native, nested = arg
+            frame = None if nested else Frame(None, locals, env)
+            stack.append(Function(env, args, body, locals, size, native, frame))
+        else:
+            raise ErioRuntimeError('Invalid instruction: {}'.format(op))
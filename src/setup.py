@@ -0,0 +1,12 @@
+'''Builds the optional Cython core of the interpreter.
+
+Run 'python setup.py build_ext --inplace' in this directory. erio.py works
+without it, and uses it when it has been built.'''
+
+from setuptools import setup
+from Cython.Build import cythonize
+
+setup(
+    name='erio_core',
+    ext_modules=cythonize('erio_core.pyx', language_level=3),
+)
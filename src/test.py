@@ -1,7 +1,14 @@
 #!/usr/bin/env python3
 import unittest
+import functools
+import io
 from erio import *
 
+@functools.lru_cache(maxsize=None)
+def _parsed(src):
+    '''Parses each test program once, however many times it is run'''
+    return tuple(parse(tokenize(src)))
+
 class TokenizerTests(unittest.TestCase):
     '''Test cases for the erio tokenizer'''
 
@@ -53,7 +60,24 @@ class TokenizerTests(unittest.TestCase):
             self.assertEqual(token.type, t)
             self.assertEqual(token.value, v)
 
-        self.assertRaises(StopIteration, next, it)
+        self.assertIsNone(next(it, None))
+
+    def test_invalid_tokens(self):
+        '''Tests the tokenizer with invalid tokens'''
+        for test_string in ('end-foo', '12ab', '"unterminated', 'a ! b',
+                            'a \u2192 b', '1\u03b1'):
+            it = tokenize(test_string)
+            self.assertRaises(ErioInvalidTokenError, list, it)
+
+    def test_unicode(self):
+        '''Tests identifiers and whitespace beyond latin-1'''
+        results = tuple(tokenize('\u03b1 =\u30001\u2003\u03b2x2'))
+        expected_results = (
+            ('identifier',  '\u03b1'),
+            ('assignment',  '='),
+            ('integer',     '1'),
+            ('identifier',  '\u03b2x2'))
+        self.assertEqual(results, expected_results)
 
 class ParserTests(unittest.TestCase):
     '''Test for the erio parser'''
@@ -75,31 +99,31 @@ class ParserTests(unittest.TestCase):
                 array = [1, 2]'''))
         expected_results = [
             AssignmentStmnt(Token('identifier', 'test'),
-                                ConstantExpr(Token('boolean', 'true'))),
+                                ConstantExpr(Boolean(True))),
             IfStmnt(VariableExpr(Token('identifier', 'test')),
                         [AssignmentStmnt(Token('identifier', 'total'),
-                                            ConstantExpr(Token('integer', '1')))],
+                                            ConstantExpr(Integer(1)))],
                         [AssignmentStmnt(Token('identifier', 'total'),
-                                            ConstantExpr(Token('integer', '2')))]),
+                                            ConstantExpr(Integer(2)))]),
             AssignmentStmnt(Token('identifier', 'count'),
-                            ConstantExpr(Token('integer', '0'))),
+                            ConstantExpr(Integer(0))),
             WhileStmnt(FunctionCall(Token('identifier', 'lt'),
                                         [VariableExpr(Token('identifier', 'count')),
                                          VariableExpr(Token('identifier', 'total'))]),
                            [FunctionCall(Token('identifier', 'print'),
-                                        [ConstantExpr(Token('string', '"hello"')),
-                                         ConstantExpr(Token('string', '"world!"'))]),
+                                        [ConstantExpr(String('hello')),
+                                         ConstantExpr(String('world!'))]),
                             AssignmentStmnt(Token('identifier', 'count'),
                                                 FunctionCall(Token('identifier', 'add'),
                                                              [VariableExpr(Token('identifier', 'count')),
-                                                              ConstantExpr(Token('integer', '1'))]))]),
+                                                              ConstantExpr(Integer(1))]))]),
             AssignmentStmnt(Token('identifier', 'array'),
                                 SequenceExpr([
-                                    ConstantExpr(Token('integer', '1')),
-                                    ConstantExpr(Token('integer', '2'))]))]
-        results = list(program)
-        self.assertListEqual(results, expected_results)
-        self.assertRaises(StopIteration, next, program)
+                                    ConstantExpr(Integer(1)),
+                                    ConstantExpr(Integer(2))]))]
+        results = tuple(program)
+        self.assertEqual(results, tuple(expected_results))
+        self.assertIsNone(next(program, None))
 
     def test_parse_function_def(self):
         '''Tests the parser to see if it can handle function declarations'''
@@ -115,9 +139,9 @@ class ParserTests(unittest.TestCase):
                                     Token('identifier', 'add'),
                                     [VariableExpr(Token('identifier', 'x')),
                                      VariableExpr(Token('identifier', 'y'))]))])]
-        results = list(program)
-        self.assertListEqual(results, expected_results)
-        self.assertRaises(StopIteration, next, program)
+        results = tuple(program)
+        self.assertEqual(results, tuple(expected_results))
+        self.assertIsNone(next(program, None))
 
     def test_numeric_operators(self):
         ''' Tests the parsing of infix numeric operators'''
@@ -130,27 +154,27 @@ class ParserTests(unittest.TestCase):
         expected_results = [
             AssignmentStmnt(Token('identifier', 'x'),
                             AddExpr(Token('add', '+'),
-                                    ConstantExpr(Token('integer', '1')),
-                                    ConstantExpr(Token('integer', '1')))),
+                                    ConstantExpr(Integer(1)),
+                                    ConstantExpr(Integer(1)))),
             AssignmentStmnt(Token('identifier', 'x'),
                             AddExpr(Token('sub', '-'),
-                                    ConstantExpr(Token('integer', '1')),
-                                    ConstantExpr(Token('integer', '1')))),
+                                    ConstantExpr(Integer(1)),
+                                    ConstantExpr(Integer(1)))),
             AssignmentStmnt(Token('identifier', 'x'),
                             MulExpr(Token('mul', '*'),
-                                    ConstantExpr(Token('integer', '1')),
-                                    ConstantExpr(Token('integer', '1')))),
+                                    ConstantExpr(Integer(1)),
+                                    ConstantExpr(Integer(1)))),
             AssignmentStmnt(Token('identifier', 'x'),
                             MulExpr(Token('div', '/'),
-                                    ConstantExpr(Token('integer', '1')),
-                                    ConstantExpr(Token('integer', '1')))),
+                                    ConstantExpr(Integer(1)),
+                                    ConstantExpr(Integer(1)))),
             AssignmentStmnt(Token('identifier', 'x'),
                             MulExpr(Token('mod', '%'),
-                                    ConstantExpr(Token('integer', '1')),
-                                    ConstantExpr(Token('integer', '1'))))]
-        results = list(program)
-        self.assertListEqual(results, expected_results)
-        self.assertRaises(StopIteration, next, program)
+                                    ConstantExpr(Integer(1)),
+                                    ConstantExpr(Integer(1))))]
+        results = tuple(program)
+        self.assertEqual(results, tuple(expected_results))
+        self.assertIsNone(next(program, None))
 
     def test_comparison_operators(self):
         ''' Tests the parsing of infix comparison operators'''
@@ -164,31 +188,31 @@ class ParserTests(unittest.TestCase):
         expected_results = [
             AssignmentStmnt(Token('identifier', 'x'),
                             CompExpr(Token('eq', '=='),
-                                     ConstantExpr(Token('integer', '1')),
-                                     ConstantExpr(Token('integer', '1')))),
+                                     ConstantExpr(Integer(1)),
+                                     ConstantExpr(Integer(1)))),
             AssignmentStmnt(Token('identifier', 'x'),
                             CompExpr(Token('gt', '>'),
-                                     ConstantExpr(Token('integer', '1')),
-                                     ConstantExpr(Token('integer', '1')))),
+                                     ConstantExpr(Integer(1)),
+                                     ConstantExpr(Integer(1)))),
             AssignmentStmnt(Token('identifier', 'x'),
                             CompExpr(Token('lt', '<'),
-                                     ConstantExpr(Token('integer', '1')),
-                                     ConstantExpr(Token('integer', '1')))),
+                                     ConstantExpr(Integer(1)),
+                                     ConstantExpr(Integer(1)))),
             AssignmentStmnt(Token('identifier', 'x'),
                             CompExpr(Token('gteq', '>='),
-                                     ConstantExpr(Token('integer', '1')),
-                                     ConstantExpr(Token('integer', '1')))),
+                                     ConstantExpr(Integer(1)),
+                                     ConstantExpr(Integer(1)))),
             AssignmentStmnt(Token('identifier', 'x'),
                             CompExpr(Token('lteq', '<='),
-                                     ConstantExpr(Token('integer', '1')),
-                                     ConstantExpr(Token('integer', '1')))),
+                                     ConstantExpr(Integer(1)),
+                                     ConstantExpr(Integer(1)))),
             AssignmentStmnt(Token('identifier', 'x'),
                             CompExpr(Token('noteq', '!='),
-                                     ConstantExpr(Token('integer', '1')),
-                                     ConstantExpr(Token('integer', '1'))))]
-        results = list(program)
-        self.assertListEqual(results, expected_results)
-        self.assertRaises(StopIteration, next, program)
+                                     ConstantExpr(Integer(1)),
+                                     ConstantExpr(Integer(1))))]
+        results = tuple(program)
+        self.assertEqual(results, tuple(expected_results))
+        self.assertIsNone(next(program, None))
 
     def test_logic_operators(self):
         ''' Tests the parsing of infix logic operators'''
@@ -199,18 +223,18 @@ class ParserTests(unittest.TestCase):
         expected_results = [
             AssignmentStmnt(Token('identifier', 'x'),
                             AddExpr(Token('and', 'and'),
-                                    ConstantExpr(Token('boolean', 'true')),
-                                    ConstantExpr(Token('boolean', 'false')))),
+                                    ConstantExpr(Boolean(True)),
+                                    ConstantExpr(Boolean(False)))),
             AssignmentStmnt(Token('identifier', 'x'),
                             OrExpr(Token('or', 'or'),
-                                    ConstantExpr(Token('boolean', 'true')),
-                                    ConstantExpr(Token('boolean', 'false')))),
+                                    ConstantExpr(Boolean(True)),
+                                    ConstantExpr(Boolean(False)))),
             AssignmentStmnt(Token('identifier', 'x'),
                             NotExpr(Token('not', 'not'),
-                                    ConstantExpr(Token('boolean', 'false'))))]
-        results = list(program)
-        self.assertListEqual(results, expected_results)
-        self.assertRaises(StopIteration, next, program)
+                                    ConstantExpr(Boolean(False))))]
+        results = tuple(program)
+        self.assertEqual(results, tuple(expected_results))
+        self.assertIsNone(next(program, None))
 
     def test_order_of_operations(self):
         '''Tests operator precedence for logic, comparison and arithmetic operators'''
@@ -222,24 +246,24 @@ class ParserTests(unittest.TestCase):
                                     AndExpr(Token('and', 'and'),
                                             CompExpr(Token('eq', '=='),
                                                     VariableExpr(Token('identifier', 'x')),
-                                                    ConstantExpr(Token('integer', '1'))),
+                                                    ConstantExpr(Integer(1))),
                                             CompExpr(Token('lt', '<'),
                                                      AddExpr(Token('sub', '-'),
                                                              MulExpr(Token('mul', '*'),
                                                                      VariableExpr(Token('identifier', 'y')),
-                                                                     ConstantExpr(Token('integer', '2'))),
-                                                             ConstantExpr(Token('integer', '4'))),
-                                                     ConstantExpr(Token('integer', '3')))),
+                                                                     ConstantExpr(Integer(2))),
+                                                             ConstantExpr(Integer(4))),
+                                                     ConstantExpr(Integer(3)))),
                                    NotExpr(Token('not', 'not'),
                                            CompExpr(Token('noteq', '!='),
-                                                    ConstantExpr(Token('integer', '5')),
+                                                    ConstantExpr(Integer(5)),
                                                     MulExpr(Token('mod', '%'),
                                                             VariableExpr(Token('identifier', 'z')),
-                                                            ConstantExpr(Token('integer', '6')))))))]
+                                                            ConstantExpr(Integer(6)))))))]
 
-        results = list(program)
-        self.assertListEqual(results, expected_results)
-        self.assertRaises(StopIteration, next, program)
+        results = tuple(program)
+        self.assertEqual(results, tuple(expected_results))
+        self.assertIsNone(next(program, None))
 
     def test_negative_integers(self):
         '''Tests the parsing of negative integers'''
@@ -249,15 +273,15 @@ class ParserTests(unittest.TestCase):
         expected_results = [
             AssignmentStmnt(Token('identifier', 'x'),
                             SignExpr(Token('sub', '-'),
-                                     ConstantExpr(Token('integer', '55')))),
+                                     ConstantExpr(Integer(55)))),
             AssignmentStmnt(Token('identifier', 'y'),
                             AddExpr(Token('add', '+'),
-                                    ConstantExpr(Token('integer', '55')),
+                                    ConstantExpr(Integer(55)),
                                     SignExpr(Token('sub', '-'),
                                              VariableExpr(Token('identifier', 'x')))))]
-        results = list(program)
-        self.assertListEqual(results, expected_results)
-        self.assertRaises(StopIteration, next, program)
+        results = tuple(program)
+        self.assertEqual(results, tuple(expected_results))
+        self.assertIsNone(next(program, None))
 
     def test_enclosure(self):
         '''Tests the parsing of expressions grouped by parenthesis'''
@@ -267,12 +291,17 @@ class ParserTests(unittest.TestCase):
             AssignmentStmnt(Token('identifier', 'x'),
                             MulExpr(Token('mul', '*'),
                                     AddExpr(Token('add', '+'),
-                                            ConstantExpr(Token('integer', '1')),
-                                            ConstantExpr(Token('integer', '2'))),
-                                    ConstantExpr(Token('integer', '3'))))]
-        results = list(program)
-        self.assertListEqual(results, expected_results)
-        self.assertRaises(StopIteration, next, program)
+                                            ConstantExpr(Integer(1)),
+                                            ConstantExpr(Integer(2))),
+                                    ConstantExpr(Integer(3))))]
+        results = tuple(program)
+        self.assertEqual(results, tuple(expected_results))
+        self.assertIsNone(next(program, None))
+
+    def test_empty_program(self):
+        '''Tests the parsing of a program without any statements'''
+        program = parse(tokenize('  '))
+        self.assertIsNone(next(program, None))
 
 class EvaluatorTests(unittest.TestCase):
     '''Tests for the erio evaluator'''
@@ -281,7 +310,7 @@ class EvaluatorTests(unittest.TestCase):
         '''Tests the execution of a single function call'''
         program = 'print("hello world")'
         expected_result = 'hello world'
-        result = exec_to_string(parse(tokenize(program)))
+        result = exec_to_string(iter(_parsed(program)))
         self.assertEqual(result, expected_result)
 
     def test_simple_program(self):
@@ -302,7 +331,7 @@ class EvaluatorTests(unittest.TestCase):
                     count = add(count, 1)
                 end-while'''
         expected_result = 'triumph!!!!!!!'
-        result = exec_to_string(parse(tokenize(program)))
+        result = exec_to_string(iter(_parsed(program)))
         self.assertEqual(result, expected_result)
 
     def test_function_def(self):
@@ -319,7 +348,7 @@ class EvaluatorTests(unittest.TestCase):
                 end-def
                 print(mul(6, 7))'''
         expected_result = '42'
-        result = exec_to_string(parse(tokenize(program)))
+        result = exec_to_string(iter(_parsed(program)))
         self.assertEqual(result, expected_result)
 
     def test_order_of_operations(self):
@@ -328,7 +357,7 @@ class EvaluatorTests(unittest.TestCase):
                 x = 7==1 and 10/5 <= 11 or 8*2-4 > -15 or not 5 != 9 % 6
                 print(x)'''
         expected_result = 'true'
-        result = exec_to_string(parse(tokenize(program)))
+        result = exec_to_string(iter(_parsed(program)))
         self.assertEqual(result, expected_result)
 
     def test_enclosure(self):
@@ -336,8 +365,172 @@ class EvaluatorTests(unittest.TestCase):
         program = r'''
                 print((1 + 2) * 3)'''
         expected_result = '9'
-        result = exec_to_string(parse(tokenize(program)))
+        result = exec_to_string(iter(_parsed(program)))
+        self.assertEqual(result, expected_result)
+
+    def test_scope(self):
+        '''Tests that functions see outer variables until they assign them'''
+        program = r'''
+                x = 1
+                def f(a)
+                    print(x)
+                    x = a
+                    def g(b)
+                        return x + b
+                    end-def
+                    print(g(3))
+                end-def
+                f(2)
+                print(x)'''
+        expected_result = '151'
+        result = exec_to_string(iter(_parsed(program)))
         self.assertEqual(result, expected_result)
 
+    def test_sequence_equality(self):
+        '''Tests that sequences compare their elements like scalars do'''
+        program = r'''
+                print(1 == true)
+                print([1] == [true])
+                print([0] == [false])
+                print([1, "a"] == [1, "b"])'''
+        expected_result = 'truetruetruefalse'
+        result = exec_to_string(iter(_parsed(program)))
+        self.assertEqual(result, expected_result)
+
+    def test_long_chain(self):
+        '''Tests compiling long left associative operator chains'''
+        chain = ' + '.join(['x'] * 3000)
+        program = r'''
+                def f(x)
+                    return {}
+                end-def
+                x = 1
+                print({} == 3000)
+                print(f(2))'''.format(chain, chain)
+        expected_result = 'true6000'
+        result = exec_to_string(program)
+        self.assertEqual(result, expected_result)
+
+    def test_recursion(self):
+        '''Tests recursive and mutually recursive functions'''
+        program = r'''
+                def fib(n)
+                    if n < 2 then
+                        return n
+                    end-if
+                    return fib(n - 1) + fib(n - 2)
+                end-def
+                def keep(n)
+                    x = n
+                    if n > 0 then
+                        keep(n - 1)
+                    end-if
+                    return x
+                end-def
+                def even(n)
+                    if n == 0 then
+                        return true
+                    end-if
+                    return odd(n - 1)
+                end-def
+                def odd(n)
+                    if n == 0 then
+                        return false
+                    end-if
+                    return even(n - 1)
+                end-def
+                print(fib(10))
+                print(fib(3))
+                print(keep(5))
+                print(keep(2))
+                print(even(10))
+                print(odd(7))
+                print(even(7))'''
+        expected_result = '55252truetruefalse'
+        result = exec_to_string(iter(_parsed(program)))
+        self.assertEqual(result, expected_result)
+
+    def test_source_text(self):
+        '''Tests running the same source text more than once'''
+        program = r'''
+                x = [1]
+                insert(x, 0, 2)
+                print(len(x))'''
+        expected_result = '2'
+        for i in range(2):
+            result = exec_to_string(program)
+            self.assertEqual(result, expected_result)
+
+class NativeFunctionTests(unittest.TestCase):
+    '''Tests for functions compiled to machine code with numba'''
+
+    program = r'''
+            def fact(n)
+                r = 1
+                while n > 1 do
+                    r = r * n
+                    n = n - 1
+                end-while
+                return r
+            end-def
+            def big(a)
+                return a + 99999999999999999999
+            end-def
+            def double(a)
+                return a * 2
+            end-def'''
+
+    def setUp(self):
+        if native_support() is None:
+            self.skipTest('numba is not installed')
+        #Parsed rather than passed as source text, which is compiled once and
+        #would share the functions' call counts between tests
+        self.env = build_global_environment(io.StringIO())
+        execute(self.env, parse(tokenize(self.program)))
+
+    def bytecode_call(self, name, *args):
+        '''Calls a function the same way, but without its native code'''
+        self.env['bytecode'] = self.env[name]._replace(native=None)
+        execute(self.env, 'result = bytecode({})'.format(
+            ', '.join(str(a) for a in args)))
+        return self.env['result']
+
+    def warm_up(self, name):
+        '''Calls a function's native code often enough to compile it'''
+        native = self.env[name].native
+        for i in range(NATIVE_CALL_THRESHOLD - 1):
+            self.assertIsNone(native([Integer(1)]))
+        return native
+
+    def test_native_function(self):
+        '''Tests that a hot qualifying function gives the bytecode's result'''
+        native = self.warm_up('fact')
+        self.assertEqual(native([Integer(10)]), Integer(3628800))
+        self.assertEqual(native([Integer(10)]), self.bytecode_call('fact', 10))
+
+    def test_native_overflow(self):
+        '''Tests that results which overflow 64 bits are left to bytecode'''
+        native = self.warm_up('fact')
+        self.assertIsNone(native([Integer(25)]))
+        result = exec_to_string(self.program + r'''
+                i = 0
+                while i < {} do
+                    r = fact(25)
+                    i = i + 1
+                end-while
+                print(r)'''.format(NATIVE_CALL_THRESHOLD + 1))
+        self.assertEqual(result, '15511210043330985984000000')
+
+    def test_native_large_integers(self):
+        '''Tests constants and arguments which do not fit in 64 bits'''
+        self.assertIsNone(self.env['big'].native)
+        native = self.warm_up('double')
+        self.assertIsNone(native([Integer(2 ** 64)]))
+        result = exec_to_string(self.program + r'''
+                print(big(1))
+                print(" ")
+                print(double(99999999999999999999))''')
+        self.assertEqual(result, '100000000000000000000 199999999999999999998')
+
 if __name__ == '__main__':
-    unittest.main(exit=False)
+    unittest.main(exit=False, verbosity=0, buffer=True)